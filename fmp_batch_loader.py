@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Kept out of FMP_ETF25.py so it can be imported (and tested) without running the Streamlit script.
+
+class FMPBatchLoader:
+    # DataLoader-style batching of cache misses: a worker whose ticker missed the per-ticker cache parks its download
+    # window in load(), and once every worker that could still run is parked, the pending windows go out together
+    # through download(tickers, start_date_str, end_date_str). download returns {ticker: result or Exception} and
+    # raises for failures that affect the whole request. Tickers that hit the cache never get here.
+    def __init__(self, download, task_count, num_workers, batch_size, max_wait):
+        self._download = download
+        self._num_workers = num_workers
+        self._batch_size = batch_size # Most symbols per download call
+        self._max_wait = max_wait # Seconds a parked window waits for the rest of its batch before sending what is pending
+        self._remaining_tasks = task_count
+        self._parked = 0
+        self._pending = [] # [(ticker, start_date_str, end_date_str, result slot)]
+        self._cond = threading.Condition()
+
+    def load(self, ticker, start_date_str, end_date_str):
+        # Called on a worker thread; blocks until the batch containing this window is downloaded
+        slot = {}
+        with self._cond:
+            self._pending.append((ticker, start_date_str, end_date_str, slot))
+            self._parked += 1
+            batch = self._take_batch_if_all_parked()
+        self._send(batch)
+        while True:
+            # Bounded wait: a worker stuck elsewhere (e.g. on another session's computation of the same cache key)
+            # never parks, so after max_wait whatever is pending goes out without it
+            with self._cond:
+                if self._cond.wait_for(lambda: slot, timeout=self._max_wait):
+                    break
+                batch, self._pending = self._pending, []
+            self._send(batch)
+        if 'error' in slot:
+            raise slot['error']
+        return slot['result']
+
+    def task_done(self):
+        # Called once per ticker task, hit or miss; a finished task may be the one the parked workers were waiting on
+        with self._cond:
+            self._remaining_tasks -= 1
+            batch = self._take_batch_if_all_parked()
+        self._send(batch)
+
+    def _take_batch_if_all_parked(self):
+        # Caller holds the lock. Queued tasks start as soon as a worker frees up, so nothing else can join the batch
+        # once the parked count reaches the number of tasks that can be running
+        if self._pending and self._parked >= min(self._remaining_tasks, self._num_workers):
+            batch, self._pending = self._pending, []
+            return batch
+        return None
+
+    def _send(self, batch):
+        if not batch:
+            return
+        # Only identical (start, end) windows share a request, so a short delta window never rides along on a
+        # new ticker's full-window download
+        by_window = {}
+        for ticker, start_date_str, end_date_str, slot in batch:
+            by_window.setdefault((start_date_str, end_date_str), []).append((ticker, slot))
+        chunks = [(window, items[i:i + self._batch_size])
+                  for window, items in by_window.items() for i in range(0, len(items), self._batch_size)]
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            list(executor.map(lambda chunk: self._send_chunk(*chunk), chunks))
+
+    def _send_chunk(self, window, items):
+        try:
+            results_by_ticker = self._download([ticker for ticker, _slot in items], *window)
+            results = [(slot, results_by_ticker[ticker]) for ticker, slot in items]
+        except Exception as err: # Whole-request failure: every ticker in the chunk gets the same error
+            results = [(slot, err) for _ticker, slot in items]
+        with self._cond:
+            for slot, outcome in results:
+                slot['error' if isinstance(outcome, Exception) else 'result'] = outcome
+            self._parked -= len(results) # Un-park here, not on wake-up, so a released worker already counts as running
+            self._cond.notify_all()
@@ -0,0 +1,24 @@
+import numpy as np
+from numba import njit # Importing this module raises ImportError without numba; FMP_ETF25.py treats the kernel as optional
+
+# Lives in an importable module rather than the Streamlit script, so the dispatcher is built (and its compiled code
+# loaded from the cache=True disk cache) once per process instead of on every rerun.
+# No parallel=True: Streamlit calls this from several session threads at once, and numba's parallel threading
+# layers either abort on concurrent use (workqueue) or hang at shutdown (TBB). A serial pass over a few thousand
+# rows is already well under a millisecond.
+
+@njit(cache=True)
+def normalize_columns_to_100(prices):
+    normalized = np.empty_like(prices)
+    for j in range(prices.shape[1]):
+        base = np.nan
+        for i in range(prices.shape[0]):
+            if not np.isnan(prices[i, j]):
+                base = prices[i, j]
+                break
+        if np.isnan(base) or base == 0:
+            normalized[:, j] = np.nan
+        else:
+            for i in range(prices.shape[0]):
+                normalized[i, j] = prices[i, j] / base * 100.0
+    return normalized
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+from fmp_batch_loader import FMPBatchLoader
+
+
+class RecordingDownload:
+    # Fake download: records each call and answers every ticker with (ticker, start, end)
+    def __init__(self, fail_with=None, per_ticker_errors=()):
+        self.calls = []
+        self._lock = threading.Lock()
+        self._fail_with = fail_with
+        self._per_ticker_errors = per_ticker_errors
+
+    def __call__(self, tickers, start_date_str, end_date_str):
+        with self._lock:
+            self.calls.append((tuple(tickers), start_date_str, end_date_str))
+        if self._fail_with is not None:
+            raise self._fail_with
+        return {ticker: ValueError(ticker) if ticker in self._per_ticker_errors else (ticker, start_date_str, end_date_str)
+                for ticker in tickers}
+
+
+def run_tasks(loader, tasks):
+    # tasks: {ticker: [(start, end), ...]} loaded in order on one thread per ticker, then task_done()
+    results, errors = {}, {}
+
+    def worker(ticker, windows):
+        try:
+            results[ticker] = [loader.load(ticker, start, end) for start, end in windows]
+        except Exception as err:
+            errors[ticker] = err
+        finally:
+            loader.task_done()
+
+    threads = [threading.Thread(target=worker, args=item) for item in tasks.items()]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join(timeout=5)
+    assert not any(thread.is_alive() for thread in threads)
+    return results, errors
+
+
+def test_parked_misses_share_one_request():
+    download = RecordingDownload()
+    loader = FMPBatchLoader(download, task_count=3, num_workers=3, batch_size=5, max_wait=5)
+    results, errors = run_tasks(loader, {t: [("2024-01-01", "2024-03-01")] for t in ("A", "B", "C")})
+    assert not errors
+    assert len(download.calls) == 1
+    assert sorted(download.calls[0][0]) == ["A", "B", "C"]
+    assert results["B"] == [("B", "2024-01-01", "2024-03-01")]
+
+
+def test_windows_are_never_merged_and_chunks_respect_batch_size():
+    download = RecordingDownload()
+    loader = FMPBatchLoader(download, task_count=4, num_workers=4, batch_size=2, max_wait=5)
+    tasks = {"NEW": [("2024-01-01", "2024-03-01")],
+             "OLD1": [("2024-02-28", "2024-03-01")], "OLD2": [("2024-02-28", "2024-03-01")], "OLD3": [("2024-02-28", "2024-03-01")]}
+    results, errors = run_tasks(loader, tasks)
+    assert not errors
+    windows = sorted((call[1], len(call[0])) for call in download.calls)
+    assert windows == [("2024-01-01", 1), ("2024-02-28", 1), ("2024-02-28", 2)]
+    assert results["OLD2"] == [("OLD2", "2024-02-28", "2024-03-01")]
+
+
+def test_task_done_releases_parked_workers():
+    # One miss and one cache hit: the hit's task_done is what lets the parked miss go out, well before max_wait
+    download = RecordingDownload()
+    loader = FMPBatchLoader(download, task_count=2, num_workers=2, batch_size=5, max_wait=30)
+    started = time.monotonic()
+    results, errors = run_tasks(loader, {"MISS": [("2024-01-01", "2024-03-01")], "HIT": []})
+    assert time.monotonic() - started < 5
+    assert not errors
+    assert download.calls == [(("MISS",), "2024-01-01", "2024-03-01")]
+
+
+def test_parked_worker_sends_after_max_wait():
+    # The other task neither parks nor finishes while we wait, so only the timeout can release the miss
+    download = RecordingDownload()
+    loader = FMPBatchLoader(download, task_count=2, num_workers=2, batch_size=5, max_wait=0.05)
+    assert loader.load("MISS", "2024-01-01", "2024-03-01") == ("MISS", "2024-01-01", "2024-03-01")
+    assert download.calls == [(("MISS",), "2024-01-01", "2024-03-01")]
+
+
+def test_whole_request_and_per_ticker_errors_are_raised_to_their_callers():
+    loader = FMPBatchLoader(RecordingDownload(per_ticker_errors={"BAD"}), task_count=2, num_workers=2, batch_size=5, max_wait=5)
+    results, errors = run_tasks(loader, {"OK": [("2024-01-01", "2024-03-01")], "BAD": [("2024-01-01", "2024-03-01")]})
+    assert list(errors) == ["BAD"] and "OK" in results
+
+    failure = ConnectionError("down")
+    loader = FMPBatchLoader(RecordingDownload(fail_with=failure), task_count=2, num_workers=2, batch_size=5, max_wait=5)
+    results, errors = run_tasks(loader, {"A": [("2024-01-01", "2024-03-01")], "B": [("2024-01-01", "2024-03-01")]})
+    assert not results and errors == {"A": failure, "B": failure}
+
+
+def test_second_load_in_the_same_task_is_batched_again():
+    # A stored ticker may need a head and a tail download; both go through the loader
+    download = RecordingDownload()
+    loader = FMPBatchLoader(download, task_count=2, num_workers=2, batch_size=5, max_wait=5)
+    windows = [("2023-01-01", "2023-12-31"), ("2024-03-01", "2024-03-05")]
+    results, errors = run_tasks(loader, {"A": windows, "B": windows})
+    assert not errors
+    assert sorted(call[1] for call in download.calls) == ["2023-01-01", "2024-03-01"]
+    assert all(len(call[0]) == 2 for call in download.calls)